@@ -1,11 +1,14 @@
 import argparse
+import hashlib
+import logging
 import os
 import pandas as pd
 import numpy as np
-from bids import BIDSLayout
+from bids import BIDSLayout, BIDSLayoutIndexer
+from joblib import Parallel, cpu_count, delayed, effective_n_jobs
 from pathlib import Path
 from utils import (voxel_inout_ratio, boldmask_to_targetspace,
-extract_brain, process_subject_run)
+extract_brain, index_run_files, process_subject_run, uncompressed_ram_copy, QC_RESULT_DTYPE)
 
 # Set up argument parsing
 parser = argparse.ArgumentParser(description="Setup OpenNeuro study variables")
@@ -15,9 +18,19 @@ parser.add_argument("--mask_dir", type=str, required=True, help="Repo MNI mask d
 parser.add_argument("--deriv_type", type=str, required=True, help="Derivatives type, minimal/non-minimal")
 parser.add_argument("--outdir", type=str, required=True, help="Directory where to save resulting QC pd.DataFrame")
 parser.add_argument("--tmpdir", type=str, required=True, help="Directory where to run analyses")
+parser.add_argument("--n_jobs", type=int, default=-1, help="Number of runs to process in parallel (-1 uses all cores)")
+parser.add_argument("--reset_bids_db", action="store_true", help="Re-index the derivatives instead of reusing the cached pybids database")
+parser.add_argument("--fast_skullstrip", action="store_true",
+                    help="Run the niworkflows skullstrip steps (BET -f 0.2, 3dAutomask -dilate 1, mask product) "
+                         "directly instead of through a nipype workflow")
 
 args = parser.parse_args()
 
+# Per-run details from utils are logged at DEBUG and dropped here; warnings/errors
+# from the worker processes still reach stderr
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 # Assign arguments to variables
 
 
@@ -28,6 +41,8 @@ mask_dir = Path(args.mask_dir)
 derivtype = args.deriv_type
 output_dir = Path(args.outdir).resolve()
 tmp_dir = Path(args.tmpdir).resolve()
+n_jobs = args.n_jobs
+use_nipype = not args.fast_skullstrip
 
 # change where crash logs / study working outputs go in scratch
 tmp_study = tmp_dir / study_id
@@ -39,60 +54,75 @@ os.environ["NIPYPE_CRASHFILE_DIR"] = str(tmp_study)
 mni_template = mask_dir / "tpl-MNI152NLin2009cAsym_res-02_desc-brain_T1w.nii.gz"
 mni_mask = mask_dir / "tpl-MNI152NLin2009cAsym_res-02_desc-brain_mask.nii.gz"
 
-# Build layout
-print("Building layout... for", study_id, "\n\t",derivs_path)
-fmrirepderiv_layout = BIDSLayout(derivs_path, validate=False)
-
-# Set empty list and grab tasks in OpenNeuro to iterate over
-qc_results = []
-task_list = fmrirepderiv_layout.get_tasks()
+# Every run's ANTs call reads the template as its reference image: decompress it once
+# (into /dev/shm when it fits) instead of gunzipping the .nii.gz per run. The MNI mask is
+# decoded once per worker process (utils._load_mask_bool cache), not once per run
+mni_template_dir, mni_template_ref = uncompressed_ram_copy(mni_template)
 
-for taskname in task_list:
-    subj_list = fmrirepderiv_layout.get_subjects(task=taskname)
-    
-    for sub in subj_list:
-        print("Working on:", sub, taskname)
-        session_list = [None]  # Default to None
-        if 'session' in fmrirepderiv_layout.get_entities():
-            sessions = fmrirepderiv_layout.get_sessions(subject=sub, task=taskname)
-            if sessions:
-                session_list = sessions
-        
-        for sess in session_list:
-            run_list = [None]  # Default to None
-            if 'run' in fmrirepderiv_layout.get_entities():
-                runs = fmrirepderiv_layout.get_runs(subject=sub, session=sess, task=taskname)
-                if runs:
-                    run_list = runs
-            
-            for runnum in run_list:
-                qc_result = process_subject_run(
-                    sub=sub,
-                    taskname=taskname,
-                    sess=sess,
-                    runnum=runnum,
-                    fmriprep_deriv_layout=fmrirepderiv_layout,
-                    deriv_type=derivtype,
-                    mni_template=str(mni_template),
-                    mni_mask=str(mni_mask),
-                    output_dir=str(tmp_study)
-                )
-                
-                if qc_result:
-                    qc_results.append(qc_result)
-
-# Combine results into DataFrame
-df_qcresults = pd.DataFrame(qc_results)
+# Build layout
+logger.info("Building layout... for %s\n\t%s", study_id, derivs_path)
+# pybids persists the index in tmp_study and reuses it on reruns. A cached database keeps the root
+# it was built for, so it is keyed on the derivatives path; pass --reset_bids_db when the derivs change.
+# Only filenames are queried, so JSON sidecar metadata is not indexed
+bids_db_key = hashlib.sha1(str(derivs_path).encode()).hexdigest()[:12]
+fmrirepderiv_layout = BIDSLayout(
+    derivs_path, validate=False, indexer=BIDSLayoutIndexer(validate=False, index_metadata=False),
+    database_path=tmp_study / f"bids_db-{bids_db_key}", reset_database=args.reset_bids_db
+)
+
+
+def run_in_worker(run_idx, **kwargs):
+    """Run process_subject_run in a per-process scratch dir so concurrent nipype workflows don't collide."""
+    kwargs["output_dir"] = str(tmp_study / f"worker-{os.getpid()}")
+    return run_idx, process_subject_run(**kwargs)
+
+
+# Resolve the input files of every run up front; the layout stays in this process
+run_tasks = [
+    dict(run_files, mni_template=str(mni_template_ref), mni_mask=str(mni_mask), use_nipype=use_nipype)
+    for run_files in index_run_files(fmriprep_deriv_layout=fmrirepderiv_layout, deriv_type=derivtype)
+]
+
+# Each run is independent (own ANTs call, skullstrip workflow and outputs). Results are
+# consumed as runs finish and appended to a partial .tsv, so a crashed job keeps its rows
+filename = f"study-{study_id}_check-bold_fmriprep-{derivtype}.tsv"
+partial_file = output_dir / filename.replace(".tsv", "_partial.tsv")
+logger.info("Processing %d runs with n_jobs=%s", len(run_tasks), n_jobs)
+
+# Split the cores between concurrent runs: this is what limits the ANTs/N4 subprocesses
+# of each worker (which inherit this env), so they don't each start a thread per core.
+# loky already caps OMP_NUM_THREADS in its workers
+threads_per_run = str(max(1, cpu_count() // effective_n_jobs(n_jobs)))
+os.environ.setdefault("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", threads_per_run)
+
+# Combine results into DataFrame, filling a preallocated record array by run index
+qc_records = np.zeros(len(run_tasks), dtype=QC_RESULT_DTYPE)
+qc_found = np.zeros(len(run_tasks), dtype=bool)
+with open(partial_file, "w") as partial_out:
+    partial_out.write("\t".join(QC_RESULT_DTYPE.names) + "\n")
+    qc_results = Parallel(n_jobs=n_jobs, backend="loky", batch_size=1, return_as="generator_unordered")(
+        delayed(run_in_worker)(idx, **kw) for idx, kw in enumerate(run_tasks)
+    )
+    for idx, qc_result in qc_results:
+        if qc_result:
+            qc_records[idx] = tuple(qc_result[name] for name in QC_RESULT_DTYPE.names)
+            qc_found[idx] = True
+            partial_out.write("\t".join(str(qc_result[name]) for name in QC_RESULT_DTYPE.names) + "\n")
+            partial_out.flush()
+mni_template_dir.cleanup()
+
+df_qcresults = pd.DataFrame.from_records(qc_records[qc_found])
 if df_qcresults.empty:
     raise ValueError("Error: df_qcresults is empty. No QC results found.")
 
     
 # flag if similarity is lower than .80 or voxoutmask are 
-df_qcresults["flagged"] = (
-    (df_qcresults["dice"] < 0.80) | (df_qcresults["voxoutmask"] > 20) | (df_qcresults["numvox_grtr_1e10"] > 0)
-).astype(int)
+dice = df_qcresults["dice"].to_numpy()
+voxoutmask = df_qcresults["voxoutmask"].to_numpy()
+numvox_extreme = df_qcresults["numvox_grtr_1e10"].to_numpy()
+df_qcresults["flagged"] = ((dice < 0.80) | (voxoutmask > 20) | (numvox_extreme > 0)).view(np.int8)
 
-filename = f"study-{study_id}_check-bold_fmriprep-{derivtype}.tsv"
 df_qcresults.to_csv(output_dir / filename, sep='\t', index=False)
+partial_file.unlink()
 
 
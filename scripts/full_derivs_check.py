@@ -1,8 +1,10 @@
 import argparse
+import hashlib
+import logging
 import os
 import pandas as pd
 import numpy as np
-from bids import BIDSLayout
+from bids import BIDSLayout, BIDSLayoutIndexer
 from pathlib import Path
 from utils import process_subject_run_full
 
@@ -13,15 +15,23 @@ parser.add_argument("--derivs_path", type=str, required=True, help="Path to the
 parser.add_argument("--mask_dir", type=str, required=True, help="Repo MNI mask directory path")
 parser.add_argument("--outdir", type=str, required=True, help="Directory where to save resulting QC pd.DataFrame")
 parser.add_argument("--tmpdir", type=str, required=True, help="Directory where to run analyses")
+parser.add_argument("--n_jobs", type=int, default=-1, help="Number of worker processes (-1 uses all cores)")
+parser.add_argument("--reset_bids_db", action="store_true", help="Re-index the derivatives instead of reusing the cached pybids database")
 
 args = parser.parse_args()
 
+# Per-run details from utils are logged at DEBUG and dropped here; warnings/errors
+# from the worker processes still reach stderr
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 # Assign arguments to variables using pathlib
 study_id = args.openneuro_study
 derivs_path = Path(args.derivs_path).resolve()
 mask_dir = Path(args.mask_dir)
 output_dir = Path(args.outdir).resolve()
 tmp_dir = Path(args.tmpdir).resolve()
+n_jobs = args.n_jobs if args.n_jobs > 0 else None
 
 # change where crash logs / study working outputs go in scratch
 tmp_study = tmp_dir / study_id
@@ -33,18 +43,26 @@ os.environ["NIPYPE_CRASHFILE_DIR"] = str(tmp_study)
 mni_mask = mask_dir / "tpl-MNI152NLin2009cAsym_res-02_desc-brain_mask.nii.gz"
 
 # Build layout
-print("Building layout... for", study_id, "\n\t",derivs_path)
-fmrirepderiv_layout = BIDSLayout(derivs_path, validate=False)
+logger.info("Building layout... for %s\n\t%s", study_id, derivs_path)
+# pybids persists the index in tmp_study and reuses it on reruns. A cached database keeps the root
+# it was built for, so it is keyed on the derivatives path; pass --reset_bids_db when the derivs change.
+# Only filenames are queried, so JSON sidecar metadata is not indexed
+bids_db_key = hashlib.sha1(str(derivs_path).encode()).hexdigest()[:12]
+fmrirepderiv_layout = BIDSLayout(
+    derivs_path, validate=False, indexer=BIDSLayoutIndexer(validate=False, index_metadata=False),
+    database_path=tmp_study / f"bids_db-{bids_db_key}", reset_database=args.reset_bids_db
+)
 
-df_qcresults = process_subject_run_full(fmrilayout=fmrirepderiv_layout, mni_mask=mni_mask, output_dir=output_dir)
+df_qcresults = process_subject_run_full(fmrilayout=fmrirepderiv_layout, mni_mask=mni_mask, max_workers=n_jobs)
 if df_qcresults.empty:
     raise ValueError("Error: df_qcresults is empty. No QC results found.")
 
 # flag if similarity is lower than .80 or voxoutmask are 
-df_qcresults["flagged"] = (
-    (df_qcresults["dice"] < 0.80) | (df_qcresults["voxoutmask"] > 20) | (df_qcresults["numvox_grtr_1e10"] > 0)
-).astype(int)
+dice = df_qcresults["dice"].to_numpy()
+voxoutmask = df_qcresults["voxoutmask"].to_numpy()
+numvox_extreme = df_qcresults["numvox_grtr_1e10"].to_numpy()
+df_qcresults["flagged"] = ((dice < 0.80) | (voxoutmask > 20) | (numvox_extreme > 0)).view(np.int8)
 
 filename = f"study-{study_id}_check-bold_fmriprep-nonminimal.tsv"
 df_qcresults.to_csv(output_dir / filename, sep='\t', index=False)
-print(f"Results saved to {output_dir / filename}")
+logger.info("Results saved to %s", output_dir / filename)
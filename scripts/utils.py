@@ -1,39 +1,55 @@
+import logging
+import os
+import re
 import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
 from typing import Dict, Tuple, Union, Optional
 import numpy as np
 from bids.layout import parse_file_entities
-from pyrelimri import similarity
 from niworkflows.func.util import init_skullstrip_bold_wf
+from nipype.interfaces.io import ExportFile
+from nipype.pipeline import engine as pe
 from pathlib import Path
 import pandas as pd
-from nilearn.image import load_img, math_img, new_img_like
+import nibabel as nib
+from nilearn.image import load_img
 
+logger = logging.getLogger(__name__)
 
-def voxel_inout_ratio(img_path: str, mask_path: str) -> Tuple[float, float, float]:
+
+def _image_data(img) -> np.ndarray:
+    """Return an image's voxel array in its stored dtype; arrays pass through, paths are loaded once."""
+    if isinstance(img, np.ndarray):
+        return img
+    if not hasattr(img, "dataobj"):
+        img = load_img(str(img))
+    return np.asarray(img.dataobj)
+
+
+def voxel_inout_ratio(img_path: Union[str, np.ndarray], mask_path: Union[str, np.ndarray]) -> Tuple[float, float, float]:
     """
     Calculates the percentage of non-zero voxels inside and outside a brain mask 
     for a given image.
 
     Parameters:
-    img_path (str): Path to the NIfTI image file.
-    mask_path (str): Path to the corresponding brain mask (same space).
+    img_path (str or np.ndarray): Path to the NIfTI image file, or its already loaded data.
+    mask_path (str or np.ndarray): Path to the corresponding brain mask (same space), or its data.
 
     Returns:
     percent_inside (float): Percentage of non-zero voxels inside the brain mask.
     percent_outside (float): Percentage of non-zero voxels outside the brain mask.
     ratio_invout (float): Ratio of inside versus outside percentage.
     """
-    img_nifti = load_img(img_path)
-    mask_nifti = load_img(mask_path)
-
-    # Extract numpy arrays & get nonzeros
-    img_data = img_nifti.get_fdata()
-    mask_data = mask_nifti.get_fdata() > 0      
-    nonzero_inside = np.count_nonzero(img_data[mask_data])
-    nonzero_outside = np.count_nonzero(img_data[~mask_data])
-    total_nonzero = nonzero_inside + nonzero_outside
+    # Extract numpy arrays in their on-disk dtype & count nonzeros in one blocked pass
+    img_data = _image_data(img_path)
+    mask_data = _image_data(mask_path)
+    nonzero_inside, total_nonzero, _ = _overlap_counts(img_data, mask_data, nonzero=True)
+    nonzero_outside = total_nonzero - nonzero_inside
 
     # Calculate percentages and ratio
     percent_inside = (nonzero_inside / total_nonzero) * 100 if total_nonzero != 0 else 0
@@ -43,14 +59,239 @@ def voxel_inout_ratio(img_path: str, mask_path: str) -> Tuple[float, float, floa
     return percent_inside, percent_outside, ratio_invout
 
 
-def similarity_boldtarget_metrics(img_path: Path, brainmask_path: Path, n_extreme_voxels: int):
+# Column layout of the per-run QC results returned by similarity_boldtarget_metrics.
+# String fields are Python objects: fixed-width unicode would silently truncate long filenames
+QC_RESULT_DTYPE = np.dtype([
+    ("img1", object),
+    ("img1name", object),
+    ("img2", object),
+    ("dice", "f8"),
+    ("voxinmask", "f8"),
+    ("voxoutmask", "f8"),
+    ("ratio_inoutmask", "f8"),
+    ("numvox_grtr_1e10", "i8")
+])
+
+
+@lru_cache(maxsize=4)
+def _load_mask_bool(mask_path: str) -> np.ndarray:
+    """Load a mask once per process as a read-only boolean array (e.g. the MNI mask reused by every run)."""
+    mask_data = np.asarray(load_img(mask_path).dataobj) > 0
+    mask_data.setflags(write=False)
+    return mask_data
+
+
+@lru_cache(maxsize=4)
+def _mask_bbox(mask_path: str) -> Tuple[slice, ...]:
+    """Slices of the tight bounding box around the nonzero voxels of a mask."""
+    mask_data = _load_mask_bool(mask_path)
+    bbox = []
+    for axis in range(mask_data.ndim):
+        other_axes = tuple(ax for ax in range(mask_data.ndim) if ax != axis)
+        nonzero = np.flatnonzero(mask_data.any(axis=other_axes))
+        bbox.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+    return tuple(bbox)
+
+
+@lru_cache(maxsize=4)
+def _packed_mask_bits(mask_path: str) -> np.ndarray:
+    """Mask cropped to its bounding box and bit-packed in C order, cached per process."""
+    mask_bits = np.packbits(_load_mask_bool(mask_path)[_mask_bbox(mask_path)].reshape(-1))
+    mask_bits.setflags(write=False)
+    return mask_bits
+
+
+def _ram_tmpdir(needed_bytes: int) -> Optional[str]:
+    """Return /dev/shm if it is writable with room for needed_bytes, else None (tempfile's $TMPDIR default)."""
+    shm_dir = Path("/dev/shm")
+    if shm_dir.is_dir() and os.access(shm_dir, os.W_OK) and shutil.disk_usage(shm_dir).free > needed_bytes:
+        return str(shm_dir)
+    return None
+
+
+def uncompressed_ram_copy(img_path) -> Tuple[tempfile.TemporaryDirectory, Path]:
+    """
+    Write an uncompressed (.nii) copy of a NIfTI image to a RAM-backed temp dir when
+    /dev/shm has room (else $TMPDIR), e.g. the MNI template that every run's ANTs call
+    reads as its reference image.
+
+    Parameters:
+    img_path (str or Path): Path to the (.nii.gz) image.
+
+    Returns:
+    tmp_dir (tempfile.TemporaryDirectory): Directory holding the copy, removed on cleanup().
+    copy_path (Path): Path to the uncompressed copy.
+    """
+    img = nib.load(str(img_path))
+    needed_bytes = int(np.prod(img.shape)) * img.get_data_dtype().itemsize
+    tmp_dir = tempfile.TemporaryDirectory(dir=_ram_tmpdir(needed_bytes))
+    copy_path = Path(tmp_dir.name) / f"{_nifti_stem(img_path)}.nii"
+    nib.save(img, str(copy_path))
+    return tmp_dir, copy_path
+
+
+def _mask_like(ref_img, mask_data: np.ndarray) -> nib.Nifti1Image:
+    """Wrap a boolean array as a uint8 NIfTI mask with the reference image's affine and header."""
+    # bool and uint8 share the 0/1 byte layout, so boolean masks are reinterpreted without a copy
+    mask_uint8 = mask_data.view(np.uint8) if mask_data.dtype == bool else mask_data.astype(np.uint8)
+    mask_img = nib.Nifti1Image(mask_uint8, ref_img.affine, ref_img.header)
+    mask_img.set_data_dtype(np.uint8)
+    return mask_img
+
+
+def _popcount(packed: np.ndarray) -> int:
+    """Count the set bits in a contiguous packed (np.packbits) uint8 array, 64 bits at a time."""
+    n_words = packed.size // 8
+    words = packed[:n_words * 8].view(np.uint64)
+    return int(np.bitwise_count(words).sum()) + int(np.bitwise_count(packed[n_words * 8:]).sum())
+
+
+def _overlap_counts(img_data: np.ndarray, mask_data: np.ndarray, bbox: Optional[Tuple[slice, ...]] = None,
+                    nonzero: bool = False, block_size: int = 1 << 18) -> Tuple[int, int, int]:
+    """
+    Count |A & B|, |A| and |B| for A = img_data > 0 (img_data != 0 if `nonzero`)
+    and B = mask_data > 0 in one pass.
+
+    The volumes are walked in blocks; each block is thresholded, packed 8 voxels per
+    byte and popcounted while it is cache resident, so no full-volume boolean or
+    packed temporaries are created.
+
+    If `bbox` is given, B must be empty outside it (e.g. any mask constrained by the
+    MNI mask and `_mask_bbox` of that mask): A & B and B are only counted inside the
+    box, |A| is still counted over the full volume.
+    """
+    if bbox is not None:
+        size_img = _count_voxels(img_data, nonzero=nonzero, block_size=block_size)
+        intersection, _, size_mask = _overlap_counts(img_data[bbox], mask_data[bbox], nonzero=nonzero,
+                                                     block_size=block_size)
+        return intersection, size_img, size_mask
+
+    # nibabel arrays are Fortran ordered, ravel in that order to get views
+    img_flat = img_data.ravel(order="F")
+    mask_flat = mask_data.ravel(order="F")
+
+    intersection = size_img = size_mask = 0
+    for start in range(0, img_flat.size, block_size):
+        img_block = img_flat[start:start + block_size]
+        img_bits = np.packbits(img_block != 0 if nonzero else img_block > 0)
+        mask_bits = np.packbits(mask_flat[start:start + block_size] > 0)
+        intersection += _popcount(img_bits & mask_bits)
+        size_img += _popcount(img_bits)
+        size_mask += _popcount(mask_bits)
+
+    return intersection, size_img, size_mask
+
+
+def _count_voxels(img_data: np.ndarray, nonzero: bool = False, block_size: int = 1 << 18) -> int:
+    """Count voxels > 0 (!= 0 if `nonzero`), block by block so temporaries stay cache sized."""
+    img_flat = img_data.ravel(order="F")
+    n_voxels = 0
+    for start in range(0, img_flat.size, block_size):
+        block = img_flat[start:start + block_size]
+        n_voxels += int(np.count_nonzero(block != 0 if nonzero else block > 0))
+    return n_voxels
+
+
+def _count_extreme_voxels(img_data: np.ndarray, thresh: float = 1e10, block_size: int = 1 << 18) -> int:
+    """Count voxels with |value| > thresh, block by block so temporaries stay cache sized."""
+    img_flat = img_data.ravel(order="F")
+    n_extreme = 0
+    for start in range(0, img_flat.size, block_size):
+        block = img_flat[start:start + block_size]
+        n_extreme += int(np.count_nonzero((block > thresh) | (block < -thresh)))
+    return n_extreme
+
+
+def compute_dice_and_ratio(img_path: Union[str, np.ndarray], mask_path: Union[str, np.ndarray],
+                           bbox: Optional[Tuple[slice, ...]] = None) -> Tuple[float, float, float, float]:
+    """
+    Calculates the DICE similarity and the percentage of image voxels inside and
+    outside a brain mask in a single pass, loading each image once.
+
+    Parameters:
+    img_path (str or np.ndarray): Path to the NIfTI image file, or its already loaded data.
+    mask_path (str or np.ndarray): Path to the corresponding brain mask (same space), or its data.
+    bbox (tuple of slice, optional): Bounding box outside of which the mask is empty.
+
+    Returns:
+    dice (float): DICE similarity between the binarized (> 0) image and mask.
+    percent_inside (float): Percentage of image voxels > 0 inside the brain mask.
+    percent_outside (float): Percentage of image voxels > 0 outside the brain mask.
+    ratio_invout (float): Ratio of inside versus outside percentage.
+    """
+    img_data = _image_data(img_path)
+    mask_data = _image_data(mask_path)
+    if img_data.shape != mask_data.shape:
+        raise ValueError(f"Image shape {img_data.shape} does not match mask shape {mask_data.shape}")
+
+    intersection, size_img, size_mask = _overlap_counts(img_data, mask_data, bbox=bbox)
+
+    dice = 2 * intersection / (size_img + size_mask) if (size_img + size_mask) != 0 else 0
+    percent_inside = (intersection / size_img) * 100 if size_img != 0 else 0
+    percent_outside = ((size_img - intersection) / size_img) * 100 if size_img != 0 else 0
+    ratio_invout = percent_inside / percent_outside if percent_outside != 0 else float('inf')
+
+    return dice, percent_inside, percent_outside, ratio_invout
+
+
+def _nifti_stem(img_path) -> str:
+    """Filename of a NIfTI image without its .nii.gz (or other) extension."""
+    name = Path(img_path).name
+    if name.endswith('.nii.gz'):
+        return name.removesuffix('.nii.gz')
+    return Path(name).stem
+
+
+_BIDS_ENTITY_RE = re.compile(r'(?:^|_)(sub|ses|task|run)-([a-zA-Z0-9]+)(?=[_.]|$)')
+_BIDS_ENTITY_KEYS = {'sub': 'subject', 'ses': 'session', 'task': 'task', 'run': 'run'}
+
+
+def _bids_entities(file_path) -> Dict[str, str]:
+    """
+    Extract the subject, session, task and run entities from a BIDS filename.
+
+    Uses a single precompiled regex over the filename and only falls back to
+    pybids' parse_file_entities when no subject entity is found.
+
+    Parameters:
+    file_path (str or Path): Path to (or name of) a BIDS file.
+
+    Returns:
+    dict: Entity name to value, for the entities present in the filename.
+    """
+    entities = {}
+    for prefix, value in _BIDS_ENTITY_RE.findall(Path(file_path).name):
+        entities.setdefault(_BIDS_ENTITY_KEYS[prefix], value)
+    if 'subject' not in entities:
+        parsed_dat = parse_file_entities(str(file_path))
+        entities = {key: str(parsed_dat[key]) for key in _BIDS_ENTITY_KEYS.values() if key in parsed_dat}
+
+    return entities
+
+
+def _sub_run_info(img_path) -> str:
+    """Build the 'subject-01_session-1_task-x_run-1' label of a BIDS file from its entities."""
+    parsed_dat = _bids_entities(img_path)
+    parts = []
+    for key in ['subject', 'session', 'task', 'run']:
+        if key in parsed_dat:
+            parts.append(f"{key}-{parsed_dat[key]}")
+
+    return '_'.join(parts)
+
+
+def similarity_boldtarget_metrics(img_path: Union[Path, np.ndarray], brainmask_path: Union[Path, np.ndarray],
+                                  n_extreme_voxels: int, bbox: Optional[Tuple[slice, ...]] = None,
+                                  img_name: Optional[str] = None):
     """
     Calculate similarity metrics between a BOLD image and a target brain mask.
 
     Parameters:
-    img_path (Path): Path to the BOLD image file.
-    brainmask_path (Path): Path to the brain mask file.
+    img_path (Path or np.ndarray): Path to the BOLD image file, or its already loaded data.
+    brainmask_path (Path or np.ndarray): Path to the brain mask file, or its already loaded data.
     n_extreme_voxels (int): Number of extreme value voxels to report.
+    bbox (tuple of slice, optional): Bounding box outside of which the brain mask is empty.
+    img_name (str, optional): BOLD image filename, required when img_path is an array.
 
     Returns:
     dict: Dictionary containing various similarity metrics:
@@ -64,33 +305,21 @@ def similarity_boldtarget_metrics(img_path: Path, brainmask_path: Path, n_extrem
         - numvox_grtr_1e10: Number of extreme value voxels
     """
     # Parse filename to extract BIDS info
-    parsed_dat = parse_file_entities(img_path)
-    parts = []
-    for key in ['subject', 'session', 'task', 'run']:
-        if key in parsed_dat:
-            parts.append(f"{key}-{parsed_dat[key]}")
-
-    sub_run_info = '_'.join(parts)
+    if img_name is None:
+        img_name = Path(img_path).name
+    sub_run_info = _sub_run_info(img_name)
     
-    # Calculate dice similarity
-    dice_est = similarity.image_similarity(
-        imgfile1=img_path,
-        imgfile2=brainmask_path,
-        mask=None,
-        thresh=None,
-        similarity_type='dice'
-    )
-
-    # Calculate voxel ratios
-    perc_in, perc_out, inout_ratio = voxel_inout_ratio(
-        img_path=str(img_path), 
-        mask_path=str(brainmask_path)
+    # Calculate dice similarity and voxel ratios from one load of each image
+    dice_est, perc_in, perc_out, inout_ratio = compute_dice_and_ratio(
+        img_path=img_path, 
+        mask_path=brainmask_path,
+        bbox=bbox
     )
 
     # Return results as a dictionary
     return {
         "img1": sub_run_info,
-        "img1name": img_path.name,
+        "img1name": img_name,
         "img2": "mni152",
         "dice": dice_est,
         "voxinmask": perc_in,
@@ -100,9 +329,10 @@ def similarity_boldtarget_metrics(img_path: Path, brainmask_path: Path, n_extrem
     }
     
 
-def boldmask_to_targetspace(boldmask, fov_mask, t1w_to_mni_file, boldref_to_t1w_file, mni_template, output_tmp):
+def boldmask_to_targetspace(boldmask, fov_mask, t1w_to_mni_file, boldref_to_t1w_file, mni_template, output_tmp,
+                            return_data=False):
     """
-    Transform a BOLD reference image to target MNI space using ANTs.
+    Transform the BOLD brain and FOV masks to target MNI space using one ANTs call.
 
     Parameters:
     boldmask (str or Path): Path to the BOLD mask image.
@@ -111,11 +341,15 @@ def boldmask_to_targetspace(boldmask, fov_mask, t1w_to_mni_file, boldref_to_t1w_
     boldref_to_t1w_file (str or Path): Path to the BOLD to T1w transformation file.
     mni_template (str or Path): Path to the MNI template reference image.
     output_tmp (str or Path): Path to the output directory.
+    return_data (bool): Also return the transformed images in memory.
 
     Returns:
     success (bool): True if the transformation was successful, False otherwise.
-    output_image (Path): Path to the transformed image.
+    outputs (dict): Paths to the transformed images, keyed 'refmask' and 'fovmask'.
+    output_imgs (dict): Only if return_data, the same images as in-memory Nifti1Images.
     """
+    outputs = {}
+    output_imgs = {}
     try:
         refmask = Path(boldmask)
         fovmask = Path(fov_mask)
@@ -125,130 +359,201 @@ def boldmask_to_targetspace(boldmask, fov_mask, t1w_to_mni_file, boldref_to_t1w_
         output_tmp.mkdir(parents=True, exist_ok=True)
 
         masks = {"refmask": refmask, "fovmask": fovmask}
-        outputs = {}
-
-        for mask_name, mask_path in masks.items():
-            print(f"Processing {mask_name}: {mask_path}")
-            
-            # Create consistent output filename
-            insert_str = "_space-MNI152NLin2009cAsym"
-            base_name = mask_path.stem.replace('.nii', '')  # Handle .nii.gz properly
-            out_file_name = f"{base_name}_{mask_name}{insert_str}.nii.gz"
-            output_image = output_tmp / out_file_name
-            
-            print(f"  Output: {output_image}")
-
-            # Build ANTs command
+        insert_str = "_space-MNI152NLin2009cAsym"
+
+        # Both masks are on the boldref grid: stack them as volumes of one 4D image so a
+        # single antsApplyTransforms call loads the transforms and resamples both
+        # nib.load only reads the headers, each mask is decoded once into the stack
+        ref_img = nib.load(str(refmask))
+        stacked_data = np.stack(
+            [np.asarray(nib.load(str(mask_path)).dataobj, dtype=np.float32) for mask_path in masks.values()],
+            axis=-1
+        )
+        stacked_img = nib.Nifti1Image(stacked_data, ref_img.affine, ref_img.header)
+        stacked_img.set_data_dtype(np.float32)
+
+        # The stacked input/output only exist for the ANTs round trip: keep them in a
+        # RAM-backed temp dir when /dev/shm has room (input + float32 output on the template grid)
+        n_template_voxels = int(np.prod(nib.load(str(mni_template)).shape[:3]))
+        needed_bytes = stacked_data.nbytes + stacked_data.shape[-1] * n_template_voxels * 4
+        base_name = _nifti_stem(refmask)
+        with tempfile.TemporaryDirectory(dir=_ram_tmpdir(needed_bytes)) as ants_tmp:
+            stacked_input = Path(ants_tmp) / f"{base_name}_stacked-masks.nii"  # ANTs input only, skip gzip
+            stacked_output = Path(ants_tmp) / f"{base_name}_stacked-masks{insert_str}.nii"
+            stacked_img.to_filename(str(stacked_input))
+            logger.debug("Processing %s: %s", ", ".join(masks), stacked_input)
+
+            # Build ANTs command, volumes of the 4D input are transformed as a time series
             cmd = [
                 "antsApplyTransforms",
+                "--dimensionality", "3",
+                "--input-image-type", "3",
                 "--default-value", "0",
                 "--float", "1",
-                "--input", str(mask_path),
+                "--input", str(stacked_input),
                 "--reference-image", str(mni_template),
-                "--output", str(output_image),
+                "--output", str(stacked_output),
                 "--interpolation", "Linear",
                 "--transform", str(t1w_to_mni),
                 "--transform", str(boldref_to_t1w)
             ]
             
-            print(f"Running ANTs command for {mask_name}:")
-            print(" ".join(cmd))
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            logger.debug("Running ANTs command: %s", " ".join(cmd))
+            # ANTs progress output is discarded, stderr is only decoded on failure
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
             if result.returncode != 0:
-                print(f"Error running antsApplyTransforms:\n{result.stderr}")
-                return False, {}
-            else:
-                print(f"antsApplyTransforms completed: {output_image}")
+                logger.error("Error running antsApplyTransforms:\n%s", result.stderr.decode(errors='replace'))
+                return (False, {}, {}) if return_data else (False, {})
+            logger.debug("antsApplyTransforms completed: %s", stacked_output)
+
+            # Split the transformed volumes back into one image per mask
+            warped_img = load_img(str(stacked_output))
+            warped_data = np.asarray(warped_img.dataobj)
+            for idx, (mask_name, mask_path) in enumerate(masks.items()):
+                # Create consistent output filename
+                mask_base_name = _nifti_stem(mask_path)
+                output_image = output_tmp / f"{mask_base_name}_{mask_name}{insert_str}.nii.gz"
+                mask_img = nib.Nifti1Image(np.array(warped_data[..., idx]), warped_img.affine, warped_img.header)
+                mask_img.to_filename(str(output_image))
+                logger.debug("  Output: %s", output_image)
                 outputs[mask_name] = output_image 
+                output_imgs[mask_name] = mask_img
         
-        return True, outputs
+        return (True, outputs, output_imgs) if return_data else (True, outputs)
     
     except Exception as e:
-        print(f"Error processing {boldref_file}: {str(e)}")
-        return False, outputs
+        logger.error("Error processing %s: %s", boldmask, e)
+        return (False, outputs, output_imgs) if return_data else (False, outputs)
 
 
-def extract_brain(brain_image, output_tmp):
+def extract_brain(brain_image, output_tmp, use_nipype=True):
     """
     Extract brain from a brain image.
 
+    By default runs niworkflows' skullstrip_bold_wf, as fMRIPrep does. With
+    use_nipype=False the workflow's steps are run directly, without building a
+    nipype workflow: FSL BET (frac 0.2) with its mask, AFNI 3dAutomask (dilate 1)
+    on the BET output, and the product of the two masks.
+
     Parameters:
     brain_image (Path): Path to the brain native or MNI space image.
     output_tmp (Path): Path to the output directory.
+    use_nipype (bool): Run the steps through niworkflows' skullstrip_bold_wf (default).
 
     Returns:
     tuple: (success (bool), brain_image (Path), mask_path (Path or None))
     """
+    if use_nipype:
+        return _extract_brain_workflow(brain_image=brain_image, output_tmp=output_tmp)
+
     try:
         subject_output_dir = Path(output_tmp)
+        subject_output_dir.mkdir(parents=True, exist_ok=True)
+
+        # Prepare intermediate and mask filenames; the intermediates are only read
+        # by the next step, so they skip gzip
+        brain_image = Path(brain_image)
+        bold_base = _nifti_stem(brain_image)
+        bet_target = subject_output_dir / (bold_base + "_brain")  # BET adds .nii and writes <base>_mask.nii
+        bet_mask = subject_output_dir / (bold_base + "_brain_mask.nii")
+        automask_target = subject_output_dir / (bold_base + "_automask.nii")
+        mask_target = subject_output_dir / (bold_base + "_mask.nii.gz")
+
+        cmds = [
+            (["bet", str(brain_image), str(bet_target), "-f", "0.2", "-m"], "NIFTI"),
+            (["3dAutomask", "-overwrite", "-dilate", "1", "-prefix", str(automask_target),
+              f"{bet_target}.nii"], "NIFTI"),
+            (["fslmaths", str(bet_mask), "-mul", str(automask_target), str(mask_target)], "NIFTI_GZ"),
+        ]
+
+        for cmd, fsl_output_type in cmds:
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    env=dict(os.environ, FSLOUTPUTTYPE=fsl_output_type))
+            if result.returncode != 0:
+                logger.error("Error running %s:\n%s", cmd[0], result.stderr.decode(errors='replace'))
+                return False, brain_image, None
+
+        logger.debug("Brain mask saved to: %s", mask_target)
+        return True, brain_image, mask_target
+
+    except Exception as e:
+        logger.error("Error in brain extraction: %s", e)
+        return False, brain_image, None
+
+
+def _extract_brain_workflow(brain_image, output_tmp):
+    """
+    Extract brain from a brain image with niworkflows' skullstrip_bold_wf.
+
+    Parameters:
+    brain_image (Path): Path to the brain native or MNI space image.
+    output_tmp (Path): Path to the output directory.
+
+    Returns:
+    tuple: (success (bool), brain_image (Path), mask_path (Path or None))
+    """
+    try:
+        subject_output_dir = Path(output_tmp).resolve()  # ExportFile requires an absolute out_file
         wf_dir = subject_output_dir / "working"
         wf_dir.mkdir(parents=True, exist_ok=True)
 
-        wf = init_skullstrip_bold_wf(name="skullstrip_bold_wf")
-        wf.base_dir = str(wf_dir)
-        wf.inputs.inputnode.in_file = str(brain_image)
-        result = wf.run()
-
         # Prepare mask filename
         brain_image = Path(brain_image)
-        bold_base = brain_image.name[:-7]
+        bold_base = _nifti_stem(brain_image)
         mask_name = bold_base + "_mask.nii.gz"
         mask_target = subject_output_dir / mask_name
 
-        # Find and copy mask file
-        for node in result.nodes:
-            if "skullstrip" in node.name:
-                outputs = node.result.outputs.get()
-                mask_file = outputs.get('mask_file')
-                
-                # Check for mask_file in outputs if not directly available
-                if not mask_file:
-                    for key in outputs:
-                        if key.endswith('mask_file') and outputs[key]:
-                            mask_file = outputs[key]
-                            break
-                
-                if mask_file and Path(mask_file).exists():
-                    shutil.copy(mask_file, mask_target)
-                    print(f"Brain mask copied to: {mask_target}")
-                    return True, brain_image, mask_target
-
-        print("No brain mask found.")
+        # Export the mask from the skullstrip outputnode instead of scanning node results
+        skullstrip_wf = init_skullstrip_bold_wf(name="skullstrip_bold_wf")
+        skullstrip_wf.inputs.inputnode.in_file = str(brain_image)
+        export_mask = pe.Node(
+            ExportFile(out_file=str(mask_target), check_extension=False, clobber=True),
+            name="export_mask"
+        )
+
+        wf = pe.Workflow(name="extract_brain_wf", base_dir=str(wf_dir))
+        wf.connect(skullstrip_wf, "outputnode.mask_file", export_mask, "in_file")
+        wf.run()
+
+        if mask_target.exists():
+            logger.debug("Brain mask copied to: %s", mask_target)
+            return True, brain_image, mask_target
+
+        logger.warning("No brain mask found.")
         return False, brain_image, None
 
     except Exception as e:
-        print(f"Error in brain extraction: {str(e)}")
+        logger.error("Error in brain extraction: %s", e)
         return False, brain_image, None
 
 
-def process_subject_run(sub, taskname, sess, runnum, fmriprep_deriv_layout, mni_template, mni_mask, deriv_type, output_dir):
+def _run_key(file_path):
+    """Return the (subject, task, session, run) entities of a BIDS file, None where absent."""
+    parsed_dat = _bids_entities(file_path)
+    return tuple(parsed_dat.get(key) for key in ['subject', 'task', 'session', 'run'])
+
+
+def index_run_files(fmriprep_deriv_layout, deriv_type):
     """
-    Process a single subject's run for QC metrics.
-    
+    Look up the files needed to QC every run in the layout.
+
+    Issues one layout query per file type and matches the files on their
+    subject/task/session/run entities, rather than querying per run.
+
     Parameters:
-    sub (str): Subject ID.
-    taskname (str): Task name.
-    sess (str or None): Session ID or None if not available.
-    runnum (str or None): Run number or None if not available.
     fmriprep_deriv_layout: BIDS layout object.
-    mni_template (Path): Path to MNI template image.
-    mni_mask (Path): Path to MNI mask image.
     deriv_type (str): Type of fmriprep derivative ('minimal' or 'non-minimal').
-    output_dir (Path): Output directory path.
-    
+
     Returns:
-    dict or None: QC metrics if successful, None otherwise.
+    list of dict: One entry per run with boldref, boldref-to-T1w and T1w-to-MNI files,
+    only for runs where all three are found.
     """
     if deriv_type not in ["minimal", "non-minimal"]:
         raise ValueError("deriv_type must be 'minimal' or 'non-minimal'")
-   
+
     # 1. Get transform files
     to_t1w_files = fmriprep_deriv_layout.get(
-        subject=sub,
-        task=taskname,
-        session=sess,
-        run=runnum,
         return_type='file',
         extension=".txt", 
         suffix="xfm",
@@ -256,89 +561,237 @@ def process_subject_run(sub, taskname, sess, runnum, fmriprep_deriv_layout, mni_
         to="T1w",
         mode="image"
     )
-    print(f"to_t1w_files found: {sub} {taskname} {sess} {runnum} - {len(to_t1w_files)}")
-
-    if not to_t1w_files:
-        return None
     
     # 2. Get T1w-to-MNI transform files
     t1w_to_mni_files = fmriprep_deriv_layout.get(
-        subject=sub,
         return_type='file',
         extension=".h5",
         suffix="xfm",
         to="MNI152NLin2009cAsym",
         mode="image"
     )
-    print(f"t1w_to_mni_files found: {sub} {taskname} {sess} - {len(t1w_to_mni_files)}")
-    
-    if not t1w_to_mni_files:
-        return None
     
     # 3. Get boldref images
     boldref_files = fmriprep_deriv_layout.get(
-        subject=sub,
-        task=taskname,
-        session=sess,
-        run=runnum,
         return_type='file',
         suffix="boldref",
         desc="coreg" if deriv_type == "minimal" else None,
         extension=".nii.gz"
     )
-    print(f"boldref_files found: {sub} {taskname} {sess} {runnum} - {len(boldref_files)}")
-    
-    if not boldref_files:
-        return None
+    logger.info("Files found - to_t1w: %d, t1w_to_mni: %d, boldref: %d",
+                len(to_t1w_files), len(t1w_to_mni_files), len(boldref_files))
 
-    # Create FOV image using boldref
-    boldref = load_img(boldref_files[0])
-    fov_img = new_img_like(boldref, np.ones(boldref.shape, dtype='u1'))
-    
-    boldref_path = Path(boldref_files[0])
-    base_name = boldref_path.name[:-7] if boldref_path.name.endswith('.nii.gz') else boldref_path.stem
-    fov_output_path = boldref_path.parent / f"{base_name}_fov.nii.gz"
-    fov_img.to_filename(str(fov_output_path))
+    # Keep the first file per key, as the per-run queries did
+    t1w_to_mni_by_sub = {}
+    for file_path in t1w_to_mni_files:
+        t1w_to_mni_by_sub.setdefault(_bids_entities(file_path).get('subject'), file_path)
+
+    boldref_by_run = {}
+    for file_path in boldref_files:
+        boldref_by_run.setdefault(_run_key(file_path), file_path)
+
+    to_t1w_by_run = {}
+    for file_path in to_t1w_files:
+        to_t1w_by_run.setdefault(_run_key(file_path), file_path)
+
+    run_files = []
+    for run_key, to_t1w_file in to_t1w_by_run.items():
+        boldref_file = boldref_by_run.get(run_key)
+        t1w_to_mni_file = t1w_to_mni_by_sub.get(run_key[0])
+        if boldref_file is None or t1w_to_mni_file is None:
+            logger.warning("Missing boldref or T1w-to-MNI transform, skipping: %s", run_key)
+            continue
+
+        run_files.append({
+            "boldref_file": boldref_file,
+            "to_t1w_file": to_t1w_file,
+            "t1w_to_mni_file": t1w_to_mni_file
+        })
+
+    return run_files
+
+
+def process_subject_run(boldref_file, to_t1w_file, t1w_to_mni_file, mni_template, mni_mask, output_dir,
+                        use_nipype=True):
+    """
+    Process a single subject's run for QC metrics.
+
+    The BIDS layout is not passed in so that runs can be dispatched to worker
+    processes; resolve the input files with `index_run_files` first.
     
-    # Calculate extreme values (occurs in minimal when voxels are noise)
-    out_data = boldref.get_fdata()
-    num_extreme_voxels = np.sum(np.abs(out_data) > 1e10)
+    Parameters:
+    boldref_file (str or Path): Path to the boldref image.
+    to_t1w_file (str or Path): Path to the boldref-to-T1w transformation file.
+    t1w_to_mni_file (str or Path): Path to the T1w-to-MNI transformation file.
+    mni_template (Path): Path to MNI template image.
+    mni_mask (Path): Path to MNI mask image.
+    output_dir (Path): Output directory path.
+    use_nipype (bool): Extract the brain with niworkflows' skullstrip workflow (default) instead of only N4 + 3dAutomask.
     
-    # Extract brain
-    brain_extract_success, brain_out_image, brain_mask = extract_brain(
-        brain_image=boldref_path, 
-        output_tmp=output_dir
-    )
+    Returns:
+    dict or None: QC metrics if successful, None otherwise.
+    """
+    # Create FOV image using boldref; only the header is read here, the voxel data is
+    # decoded on the helper thread below
+    boldref = nib.load(str(boldref_file))
+    fov_img = _mask_like(boldref, np.ones(boldref.shape, dtype=bool))
     
+    # Only read back by ANTs: written uncompressed to scratch, not next to the derivatives
+    boldref_path = Path(boldref_file)
+    base_name = _nifti_stem(boldref_path)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    fov_output_path = Path(output_dir) / f"{base_name}_fov.nii"
+
+    # The brain extraction below mostly waits on its tool subprocesses: write the FOV
+    # mask and decode the boldref on a helper thread meanwhile (file I/O and zlib release the GIL)
+    with ThreadPoolExecutor(max_workers=1) as io_pool:
+        fov_written = io_pool.submit(fov_img.to_filename, str(fov_output_path))
+        # Decoded once in its stored dtype (int16/float32), no float64 copy, and reused by the fallback mask
+        boldref_decoded = io_pool.submit(np.asarray, boldref.dataobj)
+
+        # Extract brain
+        brain_extract_success, brain_out_image, brain_mask = extract_brain(
+            brain_image=boldref_path, 
+            output_tmp=output_dir,
+            use_nipype=use_nipype
+        )
+        boldref_data = boldref_decoded.result()
+        fov_written.result()  # ANTs reads it next
+
+    # Calculate extreme values (occurs in minimal when voxels are noise)
+    num_extreme_voxels = _count_extreme_voxels(boldref_data)
+
     if not brain_extract_success:
-        bold_base = boldref_path.name[:-7]
+        bold_base = _nifti_stem(boldref_path)
         mask_name = bold_base + "_mask.nii.gz"
         brain_mask = Path(output_dir) / mask_name
-        binary_img = math_img('img > 0', img=boldref)
-        binary_img_conj = math_img('subbin*mnimask', subbin=binary_img, mnimask=mni_mask)
-        binary_img_conj.to_filename(brain_mask)
+        mni_mask_data = _load_mask_bool(str(mni_mask))
+        # Threshold and AND in place in one boolean buffer
+        binary_conj = np.greater(boldref_data, 0)
+        np.logical_and(binary_conj, mni_mask_data, out=binary_conj)
+        _mask_like(boldref, binary_conj).to_filename(brain_mask)
     
     # Transform BOLD FOV and brain masks to target space
-    ants_success, output_imgs = boldmask_to_targetspace(
+    ants_success, output_files, output_imgs = boldmask_to_targetspace(
         boldmask=brain_mask,
         fov_mask=fov_output_path, 
-        t1w_to_mni_file=t1w_to_mni_files[0], 
-        boldref_to_t1w_file=to_t1w_files[0], 
+        t1w_to_mni_file=t1w_to_mni_file, 
+        boldref_to_t1w_file=to_t1w_file, 
         mni_template=mni_template, 
-        output_tmp=output_dir
+        output_tmp=output_dir,
+        return_data=True
     )
 
+    if not ants_success:
+        return None
+
     # Constrain MNI mask with BOLD FOV
-    fov_base_name = fov_output_path.name[:-7] if fov_output_path.name.endswith('.nii.gz') else fov_output_path.stem
+    fov_base_name = _nifti_stem(fov_output_path)
     constrained_mask = Path(output_dir) / f"{fov_base_name}_tpl-MNI152NLin2009cAsym-mask-constrained.nii.gz"
-    fov_mni_mask = math_img('subbin*mnimask', subbin=output_imgs['fovmask'], mnimask=mni_mask)
-    fov_mni_mask.to_filename(str(constrained_mask))
+    fov_img = output_imgs['fovmask']
+    fov_mni_mask = (np.asarray(fov_img.dataobj) > 0) & _load_mask_bool(str(mni_mask))
+    _mask_like(fov_img, fov_mni_mask).to_filename(str(constrained_mask))
 
-    # Calculate QC metrics
+    # Calculate QC metrics on the in-memory masks; the files are kept for inspection
     qc_brain_checks = similarity_boldtarget_metrics(
-        img_path=output_imgs['refmask'], 
-        brainmask_path=constrained_mask, 
-        n_extreme_voxels=num_extreme_voxels
+        img_path=np.asarray(output_imgs['refmask'].dataobj), 
+        img_name=output_files['refmask'].name,
+        brainmask_path=fov_mni_mask,
+        n_extreme_voxels=num_extreme_voxels,
+        bbox=_mask_bbox(str(mni_mask))  # constrained mask lies within the MNI mask
     )
     
     return qc_brain_checks
+
+
+def _full_batch_metrics(batch, mni_mask_bits, mask_shape, bbox):
+    """
+    Calculate QC metrics for a batch of MNI-space BOLD brain masks against the MNI mask.
+
+    Parameters:
+    batch (list of str): Paths to the run brain masks, all on the MNI mask grid.
+    mni_mask_bits (np.ndarray): MNI mask cropped to `bbox` and bit-packed (see `_packed_mask_bits`).
+    mask_shape (tuple): Full shape of the MNI mask.
+    bbox (tuple of slice): Bounding box of the MNI mask.
+
+    Returns:
+    list of tuple: One QC_RESULT_DTYPE record per run.
+    """
+    run_data = [_image_data(img_path) for img_path in batch]
+    for img_path, img_data in zip(batch, run_data):
+        if img_data.shape != tuple(mask_shape):
+            raise ValueError(f"{img_path} shape {img_data.shape} does not match mask shape {tuple(mask_shape)}")
+
+    # (K, X, Y, Z) stack. The intersection can only be nonzero inside the MNI mask's
+    # bounding box: pack the cropped runs 8 voxels per byte (same order as the mask bits)
+    # and popcount their AND with the packed mask, broadcast over the batch axis
+    n_batch = len(batch)
+    imgs = np.stack([img_data > 0 for img_data in run_data])
+    img_bits = np.packbits(imgs[(slice(None),) + bbox].reshape(n_batch, -1), axis=1)
+    intersection = np.bitwise_count(img_bits & mni_mask_bits).sum(axis=1)
+    size_img = np.count_nonzero(imgs, axis=(1, 2, 3))
+    size_mask = _popcount(mni_mask_bits)
+
+    dice = np.divide(2 * intersection, size_img + size_mask, out=np.zeros(n_batch),
+                     where=(size_img + size_mask) != 0)
+    perc_in = np.divide(100 * intersection, size_img, out=np.zeros(n_batch), where=size_img != 0)
+    perc_out = np.divide(100 * (size_img - intersection), size_img, out=np.zeros(n_batch),
+                         where=size_img != 0)
+    ratio = np.divide(perc_in, perc_out, out=np.full(n_batch, np.inf), where=perc_out != 0)
+
+    # numvox_grtr_1e10 is written as 0: the inputs are binary brain masks, so a count of
+    # voxels > 1e10 can't measure anything here
+    return [
+        (_sub_run_info(img_path), Path(img_path).name, "mni152",
+         dice[offset], perc_in[offset], perc_out[offset], ratio[offset], 0)
+        for offset, img_path in enumerate(batch)
+    ]
+
+
+def _full_batch_worker(batch, mni_mask):
+    """Run _full_batch_metrics in a worker process on the MNI mask packed once per process."""
+    mni_mask = str(mni_mask)
+    return _full_batch_metrics(batch, _packed_mask_bits(mni_mask), _load_mask_bool(mni_mask).shape,
+                               _mask_bbox(mni_mask))
+
+
+def process_subject_run_full(fmrilayout, mni_mask, batch_size=16, max_workers=None):
+    """
+    Calculate QC metrics for every MNI-space BOLD brain mask in full fmriprep derivatives.
+
+    The fmriprep masks are already in MNI152NLin2009cAsym res-2 space, so they are
+    compared to the MNI mask directly. Runs are stacked `batch_size` at a time and the
+    overlap counts for the batch are computed as reductions over the stacked array.
+    Batches are spread over worker processes, each of which decodes and packs the
+    MNI mask once (the packed bounding box is ~100 KB, not worth sharing memory for).
+
+    Parameters:
+    fmrilayout: BIDS layout object.
+    mni_mask (Path): Path to MNI mask image.
+    batch_size (int): Number of run masks stacked per batch.
+    max_workers (int or None): Number of worker processes, None uses all cores.
+
+    Returns:
+    pd.DataFrame: QC metrics with one row per run (columns of QC_RESULT_DTYPE).
+    """
+    mni_brain_runs = fmrilayout.get(
+        datatype="func",
+        suffix="mask",
+        extension=".nii.gz",
+        space="MNI152NLin2009cAsym",
+        res=2,
+        desc="brain",
+        return_type="file"
+    )
+    logger.info("MNI brain masks found: %d", len(mni_brain_runs))
+
+    qc_records = np.zeros(len(mni_brain_runs), dtype=QC_RESULT_DTYPE)
+    batch_starts = list(range(0, len(mni_brain_runs), batch_size))
+    batches = [mni_brain_runs[start:start + batch_size] for start in batch_starts]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        batch_results = executor.map(_full_batch_worker, batches, repeat(str(mni_mask)))
+        for start, records in zip(batch_starts, batch_results):
+            qc_records[start:start + len(records)] = records
+
+    return pd.DataFrame.from_records(qc_records)